@@ -1,25 +1,26 @@
 """Manage outbound HTTP connections using Curl & CurlMulti"""
 
+import collections
 import io
 import os.path
 import select
+import selectors
 import socket
 import sys
 import threading
 import time
+import weakref
 
 try:
     import _cffi_backend
 except ImportError as exc:
-    print("Requires cffi")
-    sys.exit(1)
+    raise ImportError("Requires cffi") from exc
 
 try:
     from _libcurl_cffi import lib as libcurl
     from _libcurl_cffi import ffi
 except OSError as exc:
-    print("Requires libcurl")
-    sys.exit(1)
+    raise ImportError("Requires libcurl") from exc
 
 # Debug shortcut
 
@@ -27,8 +28,16 @@ except OSError as exc:
 def dprint(x): return None
 
 
+# Set when debug output is enabled - check before calling dprint() in hot
+# paths to avoid building messages that will be discarded
+DEBUG = False
+
+
 MCURL = None
 
+# Most released Curl instances kept for reuse by acquire() - more are freed
+EASY_POOL_SIZE = 32
+
 # Merging ideas from:
 #   https://github.com/pycurl/pycurl/blob/master/examples/multi-socket_action-select.py
 #   https://github.com/fsbs/aiocurl
@@ -50,37 +59,66 @@ def py2clong(plong):
     return ffi.cast("long", plong)
 
 
+# Constant option values - libcurl copies strings and longs passed to
+# curl_easy_setopt() and curl_slist_append() so these can be shared
+CTRUE = ffi.cast("long", 1)
+CFALSE = ffi.cast("long", 0)
+CSTR_NO_TE = ffi.new("char []", b"Transfer-Encoding:")
+CSTR_NO_EXPECT = ffi.new("char []", b"Expect:")
+
+# End of headers from libcurl
+CRLF = b"\r\n"
+
+
 def py2cbool(pbool):
     "Convert Python bool to long"
-    return ffi.cast("long", 1 if pbool else 0)
+    return CTRUE if pbool else CFALSE
 
 
-def cvp2pystr(cvoidp):
-    "Convert void * to Python string"
-    return ffi.string(ffi.cast("char *", cvoidp)).decode("utf-8")
+def cvp2curl(cvoidp):
+    "Convert void * created by Curl with ffi.new_handle() to Curl"
+    return ffi.from_handle(cvoidp)()
+
+
+def cvp2mcurl(cvoidp):
+    "Convert void * created by MCurl with ffi.new_handle() to MCurl"
+    return ffi.from_handle(cvoidp)()
 
 
 def sanitized(msg):
     "Hide user sensitive data from debug output"
-    lower = msg.lower()
-    # Hide auth responses and username
-    if "authorization: " in lower or "authenticate: " in lower:
-        fspace = lower.find(" ")
+    # Only lowercase the header name - most headers are not auth related
+    colon = msg.find(": ")
+    if colon != -1 and msg[:colon].lower().endswith(("authorization", "authenticate")):
+        # Hide auth responses
+        fspace = msg.find(" ")
         if fspace != -1:
-            sspace = lower.find(" ", fspace + 1)
+            sspace = msg.find(" ", fspace + 1)
             if sspace != -1:
                 return msg[0:sspace] + " sanitized len(%d)" % len(msg[sspace:])
-    elif lower.startswith("proxy auth using"):
-        fspace = lower.find(" ", len("proxy auth using "))
+    elif msg[:len("proxy auth using")].lower() == "proxy auth using":
+        # Hide username
+        fspace = msg.find(" ", len("proxy auth using "))
         if fspace != -1:
             return msg[0:fspace] + " sanitized len(%d)" % len(msg[fspace:])
 
     return msg
 
 
+def getbytesio(bio, encoding):
+    "Return contents of BytesIO as bytes or decoded str if encoding specified"
+    if not isinstance(bio, io.BytesIO):
+        return b"" if encoding is None else ""
+    if encoding is None:
+        return bio.getvalue()
+    # Decode straight from the buffer to skip an intermediate bytes copy
+    with bio.getbuffer() as view:
+        return str(view, encoding)
+
+
 def gethash(easy):
     "Return hash value for easy to allow usage as a dict key"
-    return str(int(ffi.cast("uintptr_t", easy)))
+    return int(ffi.cast("uintptr_t", easy))
 
 
 def getauth(auth):
@@ -96,46 +134,90 @@ def getauth(auth):
       Prefix SAFENO to avoid method - e.g. SAFENONTLM => ANYSAFE - NTLM
       Prefix ONLY to support only that method - e.g ONLYNTLM => ONLY + NTLM
     """
-    authval = libcurl.CURLAUTH_NONE
-    if auth == "NONE":
-        return authval
-
-    if auth.startswith("NO"):
-        auth = auth[len("NO"):]
-        authval = libcurl.CURLAUTH_ANY & ~(
-            getattr(libcurl, "CURLAUTH_" + auth))
-    elif auth.startswith("SAFENO"):
-        auth = auth[len("SAFENO"):]
-        authval = libcurl.CURLAUTH_ANYSAFE & ~(
-            getattr(libcurl, "CURLAUTH_" + auth))
-    elif auth.startswith("ONLY"):
-        auth = auth[len("ONLY"):]
-        authval = libcurl.CURLAUTH_ONLY | getattr(libcurl, "CURLAUTH_" + auth)
-    else:
+    authval = AUTHTYPES.get(auth)
+    if authval is None:
+        # Not supported by libcurl - raises AttributeError
         authval = getattr(libcurl, "CURLAUTH_" + auth)
 
     return authval
 
 
+def get_authtypes():
+    "Return dict of all auth strings supported by getauth() and their values"
+    authtypes = {}
+    auths = [name for name in dir(libcurl) if name.startswith("CURLAUTH_")]
+    for name in auths:
+        auth = name[len("CURLAUTH_"):]
+        authval = getattr(libcurl, name)
+        authtypes["NO" + auth] = libcurl.CURLAUTH_ANY & ~authval
+        authtypes["SAFENO" + auth] = libcurl.CURLAUTH_ANYSAFE & ~authval
+        authtypes["ONLY" + auth] = libcurl.CURLAUTH_ONLY | authval
+
+    # Direct values take precedence over prefixed ones
+    for name in auths:
+        authtypes[name[len("CURLAUTH_"):]] = getattr(libcurl, name)
+
+    return authtypes
+
+
+# Resolved once since getauth() is called for every request with auth
+AUTHTYPES = get_authtypes()
+
+
+def get_httpversions():
+    "Return dict of request versions like HTTP/1.1 and their CURL_HTTP_VERSION_* value"
+    httpversions = {}
+    for name in dir(libcurl):
+        if name.startswith("CURL_HTTP_VERSION_"):
+            version = "HTTP/" + name[len("CURL_HTTP_VERSION_"):].replace("_", ".")
+            httpversions[version] = py2clong(getattr(libcurl, name))
+
+    return httpversions
+
+
+# Resolved once since _setup() sets the HTTP version for every request
+HTTPVERSIONS = get_httpversions()
+
+
+def get_cainfo():
+    "Return path to bundled CA certs if they should be used, else None"
+    if sys.platform != "win32":
+        # libcurl uses schannel on Windows which uses system CA certs
+        cainfo = os.path.join(os.path.dirname(__file__), "cacert.pem")
+        if os.path.exists(cainfo):
+            return cainfo
+
+    return None
+
+
+# Resolved once to avoid a stat() per request in _setup()
+CAINFO = get_cainfo()
+CCAINFO = py2cstr(CAINFO) if CAINFO is not None else ffi.NULL
+
+
 def save_auth(curl, msg):
     "Find and cache proxy auth mechanism from headers sent by libcurl"
     if curl.proxy in MCURL.proxytype:
         # Already cached
-        dprint(f"{curl.easyhash}: Proxy auth mechanism already cached")
+        if DEBUG:
+            dprint(f"{curl.easyhash}: Proxy auth mechanism already cached")
         return True
 
     if curl.auth is None:
         # No need to cache auth - client will authenticate directly
-        dprint(f"{curl.easyhash}: Skipping caching proxy auth mechanism")
+        if DEBUG:
+            dprint(f"{curl.easyhash}: Skipping caching proxy auth mechanism")
         return True
 
-    dprint(f"{curl.easyhash}: Checking proxy auth mechanism: {msg}")
+    if DEBUG:
+        dprint(f"{curl.easyhash}: Checking proxy auth mechanism: {msg}")
     if msg.startswith("Proxy-Authorization:"):
         # Cache auth mechanism from proxy headers
         proxytype = msg.split(" ")[1].upper()
         MCURL.proxytype[curl.proxy] = proxytype
-        dprint(f"{curl.easyhash}: Caching proxy auth mechanism for " +
-               f"{curl.proxy} as {proxytype}")
+        if DEBUG:
+            dprint(f"{curl.easyhash}: Caching proxy auth mechanism for " +
+                   f"{curl.proxy} as {proxytype}")
 
         # Cached
         return True
@@ -150,22 +232,18 @@ def save_auth(curl, msg):
 
 def yield_msgs(data, size):
     "Generator for curl debug messages"
-    msgs = bytes(ffi.string(data)[:size]).decode("utf-8").strip()
-    if "\r\n" in msgs:
-        for msg in msgs.split("\r\n"):
-            if len(msg) != 0:
-                yield msg
-    elif len(msgs) != 0:
-        yield msgs
+    for msg in ffi.buffer(data, size)[:].splitlines():
+        if len(msg) != 0:
+            yield msg.decode("utf-8", errors="replace")
 
 
 @ffi.def_extern()
 def debug_callback(easy, infotype, data, size, userp):
     "Prints out curl debug info and headers sent/received"
 
-    del userp
-    easyhash = gethash(easy)
-    curl = MCURL.handles[easyhash]
+    del easy
+    curl = cvp2curl(userp)
+    easyhash = curl.easyhash
     if infotype == libcurl.CURLINFO_TEXT:
         prefix = easyhash + ": Curl info: "
     elif infotype == libcurl.CURLINFO_HEADER_IN:
@@ -176,7 +254,8 @@ def debug_callback(easy, infotype, data, size, userp):
         return libcurl.CURLE_OK
 
     for msg in yield_msgs(data, size):
-        dprint(prefix + sanitized(msg))
+        if DEBUG:
+            dprint(prefix + sanitized(msg))
         if infotype == libcurl.CURLINFO_HEADER_OUT:
             save_auth(curl, msg)
 
@@ -190,9 +269,8 @@ def wa_callback(easy, infotype, data, size, userp):
     - proxy auth mechanism from sent headers
     """
 
-    del userp
-    easyhash = gethash(easy)
-    curl = MCURL.handles[easyhash]
+    del easy
+    curl = cvp2curl(userp)
     if infotype == libcurl.CURLINFO_HEADER_OUT:
         # If sent header
         for msg in yield_msgs(data, size):
@@ -206,7 +284,7 @@ def wa_callback(easy, infotype, data, size, userp):
 @ffi.def_extern()
 def read_callback(buffer, size, nitems, userdata):
     tsize = size * nitems
-    curl = MCURL.handles[cvp2pystr(userdata)]
+    curl = cvp2curl(userdata)
     if curl.size is not None:
         if curl.size > tsize:
             curl.size -= tsize
@@ -218,36 +296,42 @@ def read_callback(buffer, size, nitems, userdata):
                 data = curl.client_rfile.read(tsize)
                 ffi.memmove(buffer, data, tsize)
             except ConnectionError as exc:
-                dprint(curl.easyhash + ": Error reading from client: " + str(exc))
+                if DEBUG:
+                    dprint(curl.easyhash + ": Error reading from client: " + str(exc))
                 tsize = 0
         else:
-            dprint(curl.easyhash + ": Read expected but no client")
+            if DEBUG:
+                dprint(curl.easyhash + ": Read expected but no client")
             tsize = 0
     else:
         tsize = 0
 
-    dprint(curl.easyhash + ": Read %d bytes" % tsize)
+    if DEBUG:
+        dprint(curl.easyhash + ": Read %d bytes" % tsize)
     return tsize
 
 
 @ffi.def_extern()
 def write_callback(buffer, size, nitems, userdata):
     tsize = size * nitems
-    curl = MCURL.handles[cvp2pystr(userdata)]
+    curl = cvp2curl(userdata)
     if tsize > 0:
         if curl.sentheaders:
             if curl.client_wfile is not None:
                 try:
                     tsize = curl.client_wfile.write(ffi.buffer(buffer, tsize))
                 except ConnectionError as exc:
-                    dprint(curl.easyhash +
-                           ": Error writing to client: " + str(exc))
+                    if DEBUG:
+                        dprint(curl.easyhash +
+                               ": Error writing to client: " + str(exc))
                     return 0
             else:
-                dprint(curl.easyhash + ": Ignored %d bytes" % tsize)
+                if DEBUG:
+                    dprint(curl.easyhash + ": Ignored %d bytes" % tsize)
                 return tsize
         else:
-            dprint(curl.easyhash + ": Skipped %d bytes" % tsize)
+            if DEBUG:
+                dprint(curl.easyhash + ": Skipped %d bytes" % tsize)
             return tsize
 
     # dprint(curl.easyhash + ": Wrote %d bytes" % tsize)
@@ -257,36 +341,47 @@ def write_callback(buffer, size, nitems, userdata):
 @ffi.def_extern()
 def header_callback(buffer, size, nitems, userdata):
     tsize = size * nitems
-    curl = MCURL.handles[cvp2pystr(userdata)]
+    curl = cvp2curl(userdata)
     if tsize > 0:
-        data = bytes(ffi.string(buffer)[:tsize])
-        if curl.suppress:
-            if data == b"\r\n":
-                # Stop suppressing headers since done
-                dprint(curl.easyhash + ": Resuming headers")
-                curl.suppress = False
-            return tsize
+        if curl.sentheaders and curl.auth is None:
+            # Headers already sent and nothing to suppress - write through
+            # without copying or inspecting the line
+            data = ffi.buffer(buffer, tsize)
         else:
-            if data == b"\r\n":
-                # Done sending headers
-                dprint(curl.easyhash + ": Done sending headers")
-                curl.sentheaders = True
-            elif curl.auth is not None and data[0] == 72 and b"407" in data:
-                # Header starts with H and has 407 - HTTP/x.x 407 (issue #148)
-                # Px is configured to authenticate so don't send auth related
-                # headers from upstream proxy to client
-                dprint(curl.easyhash + ": Suppressing headers")
-                curl.suppress = True
+            data = ffi.buffer(buffer, tsize)[:]
+            if curl.suppress:
+                if data == CRLF:
+                    # Stop suppressing headers since done
+                    if DEBUG:
+                        dprint(curl.easyhash + ": Resuming headers")
+                    curl.suppress = False
                 return tsize
+            else:
+                if data == CRLF:
+                    # Done sending headers
+                    if DEBUG:
+                        dprint(curl.easyhash + ": Done sending headers")
+                    curl.sentheaders = True
+                elif curl.auth is not None and data.startswith(b"HTTP/") and b" 407" in data[:16]:
+                    # Status line is HTTP/x.x 407 (issue #148) - only check the
+                    # start of the line
+                    # Px is configured to authenticate so don't send auth related
+                    # headers from upstream proxy to client
+                    if DEBUG:
+                        dprint(curl.easyhash + ": Suppressing headers")
+                    curl.suppress = True
+                    return tsize
         if curl.client_hfile is not None:
             try:
                 return curl.client_hfile.write(data)
             except ConnectionError as exc:
-                dprint(curl.easyhash +
-                       ": Error writing header to client: " + str(exc))
+                if DEBUG:
+                    dprint(curl.easyhash +
+                           ": Error writing header to client: " + str(exc))
                 return 0
         else:
-            dprint(curl.easyhash + ": Ignored %d bytes" % tsize)
+            if DEBUG:
+                dprint(curl.easyhash + ": Ignored %d bytes" % tsize)
             return tsize
 
     return 0
@@ -295,43 +390,29 @@ def header_callback(buffer, size, nitems, userdata):
 class Curl:
     "Helper class to manage a curl easy instance"
 
-    # Data
-    easy = None
-    easyhash = None
-    ceasyhash = ffi.NULL
-    sock_fd = None
-
-    # For plain HTTP
-    client_rfile = None
-    client_wfile = None
-    client_hfile = None
-
-    # Request info
-    auth = None
-    headers = ffi.NULL
-    method = None
-    proxy = None
-    request_version = None
-    size = None
-    url = None
-    user = None
-    xheaders = None
-
-    # Status
-    cerr = libcurl.CURLE_OK
-    done = False
-    errstr = ""
-    resp = 503
-    sentheaders = False
-    suppress = False
-
-    # Flags
-    is_connect = False
-    is_easy = False
-    is_patch = False
-    is_post = False
-    is_tunnel = False
-    is_upload = False
+    # Fixed attributes - smaller instances with faster attribute access
+    # since many can be active at once. Fields used in the libcurl callbacks
+    # are listed first.
+    __slots__ = (
+        # Callbacks
+        "easyhash", "easykey", "_handle", "client_rfile", "client_wfile", "client_hfile",
+        "size", "auth", "proxy", "sentheaders", "suppress",
+
+        # Data
+        "easy", "multi", "sock_fd",
+
+        # Request info
+        "headers", "method", "request_version", "url", "user", "xheaders",
+
+        # Status
+        "cerr", "done", "errstr", "resp",
+
+        # Flags
+        "is_connect", "is_easy", "is_patch", "is_post", "is_prealloc", "is_tunnel",
+        "is_upload",
+
+        "__weakref__"
+    )
 
     def __init__(self, url, method="GET", request_version="HTTP/1.1", connect_timeout=60):
         """
@@ -344,13 +425,98 @@ class Curl:
         if MCURL is None:
             MCURL = MCurl()
 
+        # Data
         self.easy = libcurl.curl_easy_init()
-        self.easyhash = gethash(self.easy)
-        self.ceasyhash = py2cstr(self.easyhash)
-        dprint(self.easyhash + ": New curl instance")
+        self.easykey = gethash(self.easy)
+        self.easyhash = str(self.easykey)  # Prefix for debug output
+        self.multi = None  # MCurl this handle was added to
+        self.sock_fd = None
+
+        # Passed to libcurl callbacks to get back to this instance - weakref
+        # avoids a reference cycle that would delay __del__()
+        self._handle = ffi.new_handle(weakref.ref(self))
+
+        # For plain HTTP
+        self.client_rfile = None
+        self.client_wfile = None
+        self.client_hfile = None
+
+        # Request info
+        self.auth = None
+        self.headers = ffi.NULL
+        self.method = None
+        self.proxy = None
+        self.request_version = None
+        self.size = None
+        self.url = None
+        self.user = None
+        self.xheaders = None
+
+        # Status
+        self.cerr = libcurl.CURLE_OK
+        self.done = False
+        self.errstr = ""
+        self.resp = 503
+        self.sentheaders = False
+        self.suppress = False
+
+        # Flags
+        self.is_connect = False
+        self.is_easy = False
+        self.is_patch = False
+        self.is_post = False
+        self.is_prealloc = False
+        self.is_tunnel = False
+        self.is_upload = False
+
+        if DEBUG:
+            dprint(self.easyhash + ": New curl instance")
 
         self._setup(url, method, request_version, connect_timeout)
 
+    @classmethod
+    def acquire(cls, url, method="GET", request_version="HTTP/1.1", connect_timeout=60):
+        """
+        Return a curl instance for this request - reuses a released instance
+        if available to avoid creating a new easy handle
+
+        Call release() once done with the instance
+        """
+        global MCURL
+        if MCURL is None:
+            MCURL = MCurl()
+
+        try:
+            curl = MCURL.easy_pool.pop()
+        except IndexError:
+            return cls(url, method, request_version, connect_timeout)
+
+        curl.reset(url, method, request_version, connect_timeout)
+        return curl
+
+    def release(self):
+        "Return this curl instance for reuse by acquire() - do not use after this"
+        if DEBUG:
+            dprint(self.easyhash + ": Releasing curl")
+        if self.multi is not None:
+            # Detach from the multi that ran it, may not be the global one
+            self.multi.remove(self)
+
+        # Don't hold on to request data while pooled
+        self.client_rfile = None
+        self.client_wfile = None
+        self.client_hfile = None
+        if self.headers is not None:
+            # Free curl headers if any - unset first so the handle does not
+            # point to freed memory
+            libcurl.curl_easy_setopt(
+                self.easy, libcurl.CURLOPT_HTTPHEADER, ffi.NULL)
+            libcurl.curl_slist_free_all(self.headers)
+            self.headers = None
+
+        if MCURL is not None and len(MCURL.easy_pool) < EASY_POOL_SIZE:
+            MCURL.easy_pool.append(self)
+
     def __del__(self):
         "Destructor - clean up resources"
         if libcurl is not None:
@@ -361,8 +527,9 @@ class Curl:
 
     def _setup(self, url, method, request_version, connect_timeout):
         "Setup curl instance based on request info"
-        dprint(self.easyhash + ": %s %s using %s" %
-               (method, url, request_version))
+        if DEBUG:
+            dprint(self.easyhash + ": %s %s using %s" %
+                   (method, url, request_version))
 
         # Ignore proxy environment variables
         libcurl.curl_easy_setopt(self.easy, libcurl.CURLOPT_PROXY, ffi.NULL)
@@ -374,30 +541,29 @@ class Curl:
         # libcurl.curl_easy_setopt(self.easy, libcurl.CURLOPT_TIMEOUT, py2clong(60))
 
         # SSL CAINFO
-        if sys.platform != "win32":
-            # libcurl uses schannel on Windows which uses system CA certs
-            cainfo = os.path.join(os.path.dirname(__file__), "cacert.pem")
-            if os.path.exists(cainfo):
-                dprint(self.easyhash + ": Using CAINFO from " + cainfo)
-                libcurl.curl_easy_setopt(
-                    self.easy, libcurl.CURLOPT_CAINFO, py2cstr(cainfo))
+        if CAINFO is not None:
+            if DEBUG:
+                dprint(self.easyhash + ": Using CAINFO from " + CAINFO)
+            libcurl.curl_easy_setopt(
+                self.easy, libcurl.CURLOPT_CAINFO, CCAINFO)
 
         # Set HTTP method
         self.method = method
         if method == "CONNECT":
             self.is_connect = True
             libcurl.curl_easy_setopt(
-                self.easy, libcurl.CURLOPT_CONNECT_ONLY, py2cbool(True))
+                self.easy, libcurl.CURLOPT_CONNECT_ONLY, CTRUE)
 
             # No proxy yet so setup tunnel for direct CONNECT
             self.set_tunnel()
 
-            if curl_version() < 0x072D00:
+            if not CURL_HAS_ACTIVESOCKET:
                 # libcurl < v7.45 does not support CURLINFO_ACTIVESOCKET so it is not possible
                 # to reuse existing connections
                 libcurl.curl_easy_setopt(
-                    self.easy, libcurl.CURLOPT_FRESH_CONNECT, py2cbool(True))
-                dprint(self.easyhash + ": Fresh connection requested")
+                    self.easy, libcurl.CURLOPT_FRESH_CONNECT, CTRUE)
+                if DEBUG:
+                    dprint(self.easyhash + ": Fresh connection requested")
 
                 # Need to know socket assigned for CONNECT since used later in select()
                 # CURLINFO_ACTIVESOCKET not available on libcurl < v7.45  so need this
@@ -405,7 +571,7 @@ class Curl:
                 libcurl.curl_easy_setopt(
                     self.easy, libcurl.CURLOPT_SOCKOPTFUNCTION, libcurl.sockopt_callback)
                 libcurl.curl_easy_setopt(
-                    self.easy, libcurl.CURLOPT_SOCKOPTDATA, self.ceasyhash)
+                    self.easy, libcurl.CURLOPT_SOCKOPTDATA, self._handle)
 
             # We want libcurl to make a simple HTTP connection to auth
             # with the upstream proxy and let client establish SSL
@@ -413,25 +579,26 @@ class Curl:
                 url = "http://" + url
         elif method == "GET":
             libcurl.curl_easy_setopt(
-                self.easy, libcurl.CURLOPT_HTTPGET, py2cbool(True))
+                self.easy, libcurl.CURLOPT_HTTPGET, CTRUE)
         elif method == "HEAD":
             libcurl.curl_easy_setopt(
-                self.easy, libcurl.CURLOPT_NOBODY, py2cbool(True))
+                self.easy, libcurl.CURLOPT_NOBODY, CTRUE)
         elif method == "POST":
             self.is_post = True
             libcurl.curl_easy_setopt(
-                self.easy, libcurl.CURLOPT_POST, py2cbool(True))
+                self.easy, libcurl.CURLOPT_POST, CTRUE)
         elif method == "PUT":
             self.is_upload = True
             libcurl.curl_easy_setopt(
-                self.easy, libcurl.CURLOPT_UPLOAD, py2cbool(True))
+                self.easy, libcurl.CURLOPT_UPLOAD, CTRUE)
         elif method in ["PATCH", "DELETE"]:
             if method == "PATCH":
                 self.is_patch = True
             libcurl.curl_easy_setopt(
                 self.easy, libcurl.CURLOPT_CUSTOMREQUEST, py2cstr(method))
         else:
-            dprint(self.easyhash + ": Unknown method: " + method)
+            if DEBUG:
+                dprint(self.easyhash + ": Unknown method: " + method)
             libcurl.curl_easy_setopt(
                 self.easy, libcurl.CURLOPT_CUSTOMREQUEST, py2cstr(method))
 
@@ -440,20 +607,29 @@ class Curl:
 
         # Set HTTP version to use
         self.request_version = request_version
-        version = request_version.split("/")[1].replace(".", "_")
-        libcurl.curl_easy_setopt(self.easy, libcurl.CURLOPT_HTTP_VERSION,
-                                 py2clong(getattr(libcurl, "CURL_HTTP_VERSION_" + version)))
+        cversion = HTTPVERSIONS.get(request_version)
+        if cversion is None:
+            version = request_version.split("/")[1].replace(".", "_")
+            cversion = py2clong(getattr(libcurl, "CURL_HTTP_VERSION_" + version))
+        libcurl.curl_easy_setopt(self.easy, libcurl.CURLOPT_HTTP_VERSION, cversion)
 
         # Debug callback default disabled
         libcurl.curl_easy_setopt(
             self.easy, libcurl.CURLOPT_DEBUGFUNCTION, libcurl.wa_callback)
+        libcurl.curl_easy_setopt(
+            self.easy, libcurl.CURLOPT_DEBUGDATA, self._handle)
+
+        # Find this instance from the easy handle when transfers complete
+        libcurl.curl_easy_setopt(
+            self.easy, libcurl.CURLOPT_PRIVATE, self._handle)
 
         # Need libcurl verbose to save proxy auth mechanism
         self.set_verbose()
 
     def reset(self, url, method="GET", request_version="HTTP/1.1", connect_timeout=60):
         "Reuse existing curl instance for another request"
-        dprint(self.easyhash + ": Resetting curl")
+        if DEBUG:
+            dprint(self.easyhash + ": Resetting curl")
         libcurl.curl_easy_reset(self.easy)
         self.sock_fd = None
 
@@ -477,6 +653,7 @@ class Curl:
         self.is_connect = False
         self.is_patch = False
         self.is_post = False
+        self.is_prealloc = False
         self.is_tunnel = False
         self.is_upload = False
 
@@ -489,7 +666,8 @@ class Curl:
 
     def set_tunnel(self, tunnel=True):
         "Set to tunnel through proxy if no proxy or proxy + auth"
-        dprint(self.easyhash + ": HTTP proxy tunneling = " + str(tunnel))
+        if DEBUG:
+            dprint(self.easyhash + ": HTTP proxy tunneling = " + str(tunnel))
         libcurl.curl_easy_setopt(
             self.easy, libcurl.CURLOPT_HTTPPROXYTUNNEL, py2cbool(tunnel))
         libcurl.curl_easy_setopt(
@@ -499,7 +677,8 @@ class Curl:
     def set_proxy(self, proxy, port=0, noproxy=None):
         "Set proxy options - returns False if this proxy server has auth failures"
         if proxy in MCURL.failed:
-            dprint(self.easyhash + ": Authentication issues with this proxy server")
+            if DEBUG:
+                dprint(self.easyhash + ": Authentication issues with this proxy server")
             return False
 
         self.proxy = proxy
@@ -508,7 +687,8 @@ class Curl:
         libcurl.curl_easy_setopt(
             self.easy, libcurl.CURLOPT_PROXYPORT, py2clong(port))
         if noproxy is not None:
-            dprint(self.easyhash + ": Set noproxy to " + noproxy)
+            if DEBUG:
+                dprint(self.easyhash + ": Set noproxy to " + noproxy)
             libcurl.curl_easy_setopt(
                 self.easy, libcurl.CURLOPT_NOPROXY, py2cstr(noproxy))
 
@@ -531,18 +711,21 @@ class Curl:
                 libcurl.curl_easy_setopt(
                     self.easy, libcurl.CURLOPT_PROXYPASSWORD, py2cstr(password))
             else:
-                dprint(self.easyhash + ": Blank password for user")
+                if DEBUG:
+                    dprint(self.easyhash + ": Blank password for user")
         if auth is not None:
             if self.proxy in MCURL.proxytype:
                 # Use cached value
                 self.auth = MCURL.proxytype[self.proxy]
-                dprint(self.easyhash +
-                       ": Using cached proxy auth mechanism " + self.auth)
+                if DEBUG:
+                    dprint(self.easyhash +
+                           ": Using cached proxy auth mechanism " + self.auth)
             else:
                 # Use specified value
                 self.auth = auth
-                dprint(self.easyhash +
-                       ": Setting proxy auth mechanism to " + self.auth)
+                if DEBUG:
+                    dprint(self.easyhash +
+                           ": Setting proxy auth mechanism to " + self.auth)
 
             authval = getauth(self.auth)
             libcurl.curl_easy_setopt(
@@ -556,56 +739,61 @@ class Curl:
         "Set headers to send"
         self.headers = ffi.NULL
         skip_proxy_headers = True if self.proxy is not None and self.auth is not None else False
-        for header in xheaders:
+
+        # Headers are sent as is in select() if delayed so no slist needed
+        delay_headers = self.is_connect and not self.is_tunnel
+        for header, value in xheaders.items():
             lcheader = header.lower()
             if skip_proxy_headers and lcheader.startswith("proxy-"):
                 # Don't forward proxy headers from client if no upstream proxy
                 # or no auth specified (client will authenticate directly)
-                dprint(self.easyhash + ": Skipping header =!> %s: %s" %
-                       (header, xheaders[header]))
+                if DEBUG:
+                    dprint(self.easyhash + ": Skipping header =!> %s: %s" %
+                           (header, value))
                 continue
             elif lcheader == "content-length":
-                size = int(xheaders[header])
-                if self.is_upload or self.is_post:
-                    # Save content-length for PUT/POST later
+                size = int(value)
+                if self.is_upload or self.is_post or self.is_patch:
+                    # Save content-length for PUT/POST/PATCH later
                     # Turn off Transfer-Encoding since size is known
                     self.size = size
                     self.headers = libcurl.curl_slist_append(
-                        self.headers, py2cstr("Transfer-Encoding:"))
+                        self.headers, CSTR_NO_TE)
                     self.headers = libcurl.curl_slist_append(
-                        self.headers, py2cstr("Expect:"))
-                    if self.is_post:
+                        self.headers, CSTR_NO_EXPECT)
+                    if self.is_patch:
+                        # Stream body via READFUNCTION - CUSTOMREQUEST keeps
+                        # the PATCH method on the wire
+                        libcurl.curl_easy_setopt(
+                            self.easy, libcurl.CURLOPT_POST, CTRUE)
+                    if self.is_post or self.is_patch:
                         libcurl.curl_easy_setopt(
                             self.easy, libcurl.CURLOPT_POSTFIELDSIZE, py2clong(size))
                     else:
                         libcurl.curl_easy_setopt(
                             self.easy, libcurl.CURLOPT_INFILESIZE, py2clong(size))
-                elif self.is_patch:
-                    # Get data from client - libcurl doesn't seem to use READFUNCTION
-                    try:
-                        data = self.client_rfile.read(size)
-                    except AttributeError as exc:
-                        dprint("set_headers() called before buffer()/bridge()?")
-                        raise exc
-                    libcurl.curl_easy_setopt(
-                        self.easy, libcurl.CURLOPT_COPYPOSTFIELDS, py2custr(data))
             elif lcheader == "user-agent":
                 # Forward user agent via setopt
-                self.set_useragent(xheaders[header])
+                self.set_useragent(value)
+                continue
+            elif delay_headers:
                 continue
-            dprint(self.easyhash + ": Adding header => " +
-                   sanitized("%s: %s" % (header, xheaders[header])))
-            self.headers = libcurl.curl_slist_append(self.headers,
-                                                     py2cstr("%s: %s" % (header, xheaders[header])))
+
+            line = "%s: %s" % (header, value)
+            if DEBUG:
+                dprint(self.easyhash + ": Adding header => " + sanitized(line))
+            self.headers = libcurl.curl_slist_append(self.headers, py2cstr(line))
 
         if len(xheaders) != 0:
-            if self.is_connect and not self.is_tunnel:
+            if delay_headers:
                 # Send client headers later in select() - just connect to proxy
                 # and let client tunnel and authenticate directly
-                dprint(self.easyhash + ": Delaying headers")
+                if DEBUG:
+                    dprint(self.easyhash + ": Delaying headers")
                 self.xheaders = xheaders
             else:
-                dprint(self.easyhash + ": Setting headers")
+                if DEBUG:
+                    dprint(self.easyhash + ": Setting headers")
                 libcurl.curl_easy_setopt(
                     self.easy, libcurl.CURLOPT_HTTPHEADER, self.headers)
 
@@ -640,7 +828,8 @@ class Curl:
         Writes data back to client_wfile
         Writes headers back to client_hfile
         """
-        dprint(self.easyhash + ": Setting up bridge")
+        if DEBUG:
+            dprint(self.easyhash + ": Setting up bridge")
 
         # Setup read/write callbacks
         if client_rfile is not None:
@@ -648,37 +837,53 @@ class Curl:
             libcurl.curl_easy_setopt(
                 self.easy, libcurl.CURLOPT_READFUNCTION, libcurl.read_callback)
             libcurl.curl_easy_setopt(
-                self.easy, libcurl.CURLOPT_READDATA, self.ceasyhash)
+                self.easy, libcurl.CURLOPT_READDATA, self._handle)
 
         if client_wfile is not None:
             self.client_wfile = client_wfile
+            self.is_prealloc = False
             libcurl.curl_easy_setopt(
                 self.easy, libcurl.CURLOPT_WRITEFUNCTION, libcurl.write_callback)
             libcurl.curl_easy_setopt(
-                self.easy, libcurl.CURLOPT_WRITEDATA, self.ceasyhash)
+                self.easy, libcurl.CURLOPT_WRITEDATA, self._handle)
 
         if client_hfile is not None:
             self.client_hfile = client_hfile
             libcurl.curl_easy_setopt(
                 self.easy, libcurl.CURLOPT_HEADERFUNCTION, libcurl.header_callback)
             libcurl.curl_easy_setopt(
-                self.easy, libcurl.CURLOPT_HEADERDATA, self.ceasyhash)
+                self.easy, libcurl.CURLOPT_HEADERDATA, self._handle)
         else:
             self.sentheaders = True
 
-    def buffer(self, data=None):
-        "Setup buffers to bridge curl perform"
-        dprint(self.easyhash + ": Setting up buffers for bridge")
+    def buffer(self, data=None, expected_size=None):
+        """
+        Setup buffers to bridge curl perform
+
+        expected_size = response size if known, preallocates the data buffer
+        """
+        if DEBUG:
+            dprint(self.easyhash + ": Setting up buffers for bridge")
         rfile = None
         if data is not None:
             rfile = io.BytesIO()
             rfile.write(data)
             rfile.seek(0)
 
+        if expected_size is not None and expected_size < 0:
+            raise ValueError("expected_size must not be negative")
+
         wfile = io.BytesIO()
+        if expected_size:
+            # Grow once up front instead of reallocating as data arrives -
+            # trailing space is truncated once the transfer completes
+            wfile.seek(expected_size - 1)
+            wfile.write(b"\0")
+            wfile.seek(0)
         hfile = io.BytesIO()
 
         self.bridge(rfile, wfile, hfile)
+        self.is_prealloc = bool(expected_size)
 
     def set_transfer_decoding(self, enable=False):
         "Set curl to turn off transfer decoding - let client do it"
@@ -688,7 +893,8 @@ class Curl:
     def set_useragent(self, useragent):
         "Set user agent to send"
         if len(useragent) != 0:
-            dprint(self.easyhash + ": Setting user agent to " + useragent)
+            if DEBUG:
+                dprint(self.easyhash + ": Setting user agent to " + useragent)
             libcurl.curl_easy_setopt(
                 self.easy, libcurl.CURLOPT_USERAGENT, py2cstr(useragent))
 
@@ -697,17 +903,42 @@ class Curl:
         libcurl.curl_easy_setopt(
             self.easy, libcurl.CURLOPT_FOLLOWLOCATION, py2cbool(enable))
 
+    def configure(self, *, data=None, headers=None, useragent=None, insecure=False,
+                  debug=False, expected_size=None):
+        """
+        Setup buffers and common request options in one call
+
+        data, expected_size = passed to buffer()
+        headers = passed to set_headers() if any
+        useragent, insecure, debug = only set if specified
+        """
+        self.buffer(data, expected_size)
+        if headers:
+            self.set_headers(headers)
+        if useragent:
+            self.set_useragent(useragent)
+        if insecure:
+            self.set_insecure()
+        if debug:
+            self.set_debug()
+
+    def _trim(self):
+        # Drop preallocated space past the last write once the transfer is done
+        if self.is_prealloc:
+            self.client_wfile.truncate(self.client_wfile.tell())
+            self.is_prealloc = False
+
     def perform(self):
         "Perform the easy handle"
 
-        # Perform as a standalone easy handle, not using multi
-        # However, add easyhash to MCURL.handles since it is used in curl callbacks
-        MCURL.handles[self.easyhash] = self
+        # Perform as a standalone easy handle, not using multi - callbacks
+        # find this instance via the handle set in their *DATA options
         self.cerr = libcurl.curl_easy_perform(self.easy)
+        self._trim()
         if self.cerr != libcurl.CURLE_OK:
-            dprint(self.easyhash + ": Connection failed: " +
-                   str(self.cerr) + "; " + self.errstr)
-        MCURL.handles.pop(self.easyhash)
+            if DEBUG:
+                dprint(self.easyhash + ": Connection failed: " +
+                       str(self.cerr) + "; " + self.errstr)
         return self.cerr
 
     # Get status and info after running curl handle
@@ -753,12 +984,7 @@ class Curl:
 
         encoding = "utf-8" by default, change or set to None if bytes preferred
         """
-        val = b""
-        if isinstance(self.client_wfile, io.BytesIO):
-            val = self.client_wfile.getvalue()
-        if encoding is not None:
-            val = val.decode(encoding)
-        return val
+        return getbytesio(self.client_wfile, encoding)
 
     def get_headers(self, encoding="utf-8"):
         """
@@ -766,34 +992,43 @@ class Curl:
 
         encoding = "utf-8" by default, change or set to None if bytes preferred
         """
-        val = b""
-        if isinstance(self.client_hfile, io.BytesIO):
-            val = self.client_hfile.getvalue()
-        if encoding is not None:
-            val = val.decode(encoding)
-        return val
+        return getbytesio(self.client_hfile, encoding)
+
+
+# Bytes moved per recv() in the MCurl.select() tunnel loop - larger reads
+# mean fewer select/recv/send round trips per byte relayed
+TUNNEL_BUFSIZE = 65536
+
+# CURL_POLL_* to selector events, CURL_POLL_REMOVE maps to 0
+POLLEVENTS = {
+    libcurl.CURL_POLL_IN: selectors.EVENT_READ,
+    libcurl.CURL_POLL_OUT: selectors.EVENT_WRITE,
+    libcurl.CURL_POLL_INOUT: selectors.EVENT_READ | selectors.EVENT_WRITE
+}
 
 
 @ffi.def_extern()
 def socket_callback(easy, sock_fd, ev_bitmask, userp, socketp):
     # libcurl socket callback: add/remove actions for socket events
-    del easy, userp, socketp
-    if ev_bitmask & libcurl.CURL_POLL_IN or ev_bitmask & libcurl.CURL_POLL_INOUT:
-        # dprint("Read sock_fd %d" % sock_fd)
-        if sock_fd not in MCURL.rlist:
-            MCURL.rlist.append(sock_fd)
-
-    if ev_bitmask & libcurl.CURL_POLL_OUT or ev_bitmask & libcurl.CURL_POLL_INOUT:
-        # dprint("Write sock_fd %d" % sock_fd)
-        if sock_fd not in MCURL.wlist:
-            MCURL.wlist.append(sock_fd)
-
-    if ev_bitmask & libcurl.CURL_POLL_REMOVE:
-        # dprint("Remove sock_fd %d" % sock_fd)
-        if sock_fd in MCURL.rlist:
-            MCURL.rlist.remove(sock_fd)
-        if sock_fd in MCURL.wlist:
-            MCURL.wlist.remove(sock_fd)
+    del easy, socketp
+    # dprint("Poll sock_fd %d = %d" % (sock_fd, ev_bitmask))
+    mcurl = cvp2mcurl(userp)
+    events = POLLEVENTS.get(ev_bitmask, 0)
+    current = mcurl.wanted.get(sock_fd, 0)
+    if events == current:
+        return libcurl.CURLE_OK
+
+    # Registration is updated incrementally so that select() only returns
+    # ready sockets - epoll/kqueue where available
+    if events == 0:
+        del mcurl.wanted[sock_fd]
+        mcurl.sel.unregister(sock_fd)
+    else:
+        mcurl.wanted[sock_fd] = events
+        if current == 0:
+            mcurl.sel.register(sock_fd, events)
+        else:
+            mcurl.sel.modify(sock_fd, events)
 
     return libcurl.CURLE_OK
 
@@ -802,11 +1037,12 @@ def socket_callback(easy, sock_fd, ev_bitmask, userp, socketp):
 def multi_timer_callback(multi, timeout_ms, userp):
     # libcurl timer callback: schedule/cancel a timeout action
     # dprint("timeout = %d" % timeout_ms)
-    del multi, userp
+    del multi
+    mcurl = cvp2mcurl(userp)
     if timeout_ms == -1:
-        MCURL.timer = None
+        mcurl.timer = None
     else:
-        MCURL.timer = timeout_ms / 1000.0
+        mcurl.timer = timeout_ms / 1000.0
 
     return libcurl.CURLE_OK
 
@@ -815,53 +1051,81 @@ def multi_timer_callback(multi, timeout_ms, userp):
 def sockopt_callback(clientp, sock_fd, purpose):
     # Associate new socket with easy handle
     del purpose
-    curl = MCURL.handles[cvp2pystr(clientp)]
+    curl = cvp2curl(clientp)
     curl.sock_fd = sock_fd
 
     return libcurl.CURLE_OK
 
 
+# libcurl version info - static for the life of the process
+CURL_VINFO = libcurl.curl_version_info(libcurl.CURLVERSION_LAST-1)
+CURL_VERSION_NUM = CURL_VINFO.version_num
+CURL_VERSION_STR = ffi.string(libcurl.curl_version()).decode("utf-8")
+
+# CURLINFO_ACTIVESOCKET needs libcurl >= v7.45
+CURL_HAS_ACTIVESOCKET = CURL_VERSION_NUM >= 0x072D00
+
+# (name, bit) of features displayed by print_curl_version()
+VERSION_FEATURES = tuple((feature, getattr(libcurl, feature)) for feature in (
+    "CURL_VERSION_SSL", "CURL_VERSION_SSPI", "CURL_VERSION_SPNEGO",
+    "CURL_VERSION_GSSAPI", "CURL_VERSION_GSSNEGOTIATE",
+    "CURL_VERSION_KERBEROS5", "CURL_VERSION_NTLM", "CURL_VERSION_NTLM_WB"
+))
+
+
 def print_curl_version():
     "Display curl version information"
-    dprint(ffi.string(libcurl.curl_version()).decode("utf-8"))
-    vinfo = libcurl.curl_version_info(libcurl.CURLVERSION_LAST-1)
-    for feature in [
-        "CURL_VERSION_SSL", "CURL_VERSION_SSPI", "CURL_VERSION_SPNEGO",
-        "CURL_VERSION_GSSAPI", "CURL_VERSION_GSSNEGOTIATE",
-        "CURL_VERSION_KERBEROS5", "CURL_VERSION_NTLM", "CURL_VERSION_NTLM_WB"
-    ]:
-        bit = getattr(libcurl, feature)
-        avail = True if (bit & vinfo.features) > 0 else False
-        dprint("%s: %s" % (feature, avail))
-    dprint("Host: " + ffi.string(vinfo.host).decode("utf-8"))
+    if not DEBUG:
+        return
+    dprint(CURL_VERSION_STR)
+    for feature, bit in VERSION_FEATURES:
+        dprint("%s: %s" % (feature, bool(bit & CURL_VINFO.features)))
+    dprint("Host: " + ffi.string(CURL_VINFO.host).decode("utf-8"))
 
 
 def curl_version():
-    return libcurl.curl_version_info(libcurl.CURLVERSION_LAST-1).version_num
+    return CURL_VERSION_NUM
 
 
 class MCurl:
     "Helper class to manage a curl multi instance"
 
     _multi = None
-    _lock = None
+    _lock = None  # Guards the multi handle
+    _handles_lock = None  # Guards adding to and removing from handles
+    _failed_lock = None
+    _handle = None
+
+    # Notified when _perform() releases _lock or a transfer completes -
+    # do() waits on it while another thread is performing
+    _progress = None
+    _performing = False
+
+    # Out parameters for libcurl calls made under _lock
+    _handle_count = None
+    _queued = None
+    _privatep = None
+
+    # Running handles after the last socket action - handles added since
+    # are included so a completion is not masked by a new transfer starting
+    _prev_running = 0
 
     handles = None
+    easy_pool = None  # Released Curl instances for reuse
+    pending = None  # Handles queued by add() while another thread performs
     proxytype = None
     failed = None  # Proxy servers with auth failures
     timer = None
-    rlist = None
-    wlist = None
+    sel = None
+    wanted = None  # sock_fd => selector events registered
+    wakeup = None  # Socket pair to interrupt select() in _perform()
 
     def __init__(self, debug_print=None):
         "Initialize multi interface"
-        global dprint
+        global dprint, DEBUG
         if debug_print is not None:
             dprint = debug_print
-        else:
-            # No need to sanitize since no debug
-            def no_sanitized(msg): return msg
-            sanitized = no_sanitized
+            DEBUG = True
 
         # Save as global to enable access via callbacks
         global MCURL
@@ -870,25 +1134,48 @@ class MCurl:
         print_curl_version()
         self._multi = libcurl.curl_multi_init()
 
+        # Callbacks get this instance from a handle - weakref to avoid a
+        # cycle through the handle keepalive
+        self._handle = ffi.new_handle(weakref.ref(self))
+
         # Set a callback for registering or unregistering socket events.
         libcurl.curl_multi_setopt(
             self._multi, libcurl.CURLMOPT_SOCKETFUNCTION, libcurl.socket_callback)
+        libcurl.curl_multi_setopt(
+            self._multi, libcurl.CURLMOPT_SOCKETDATA, self._handle)
 
         # Set a callback for scheduling or cancelling timeout actions.
         libcurl.curl_multi_setopt(
             self._multi, libcurl.CURLMOPT_TIMERFUNCTION, libcurl.multi_timer_callback)
+        libcurl.curl_multi_setopt(
+            self._multi, libcurl.CURLMOPT_TIMERDATA, self._handle)
 
         # Init
         self.handles = {}
+        self.easy_pool = collections.deque()
+        self.pending = collections.deque()
         self.proxytype = {}
         self.failed = []
-        self.rlist = []
-        self.wlist = []
+        self.sel = selectors.DefaultSelector()
+        self.wanted = {}
+        self.wakeup = socket.socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
+        self.sel.register(self.wakeup[0], selectors.EVENT_READ)
         self._lock = threading.Lock()
+        self._handles_lock = threading.Lock()
+        self._failed_lock = threading.Lock()
+        self._progress = threading.Condition()
+        self._performing = False
+        self._handle_count = ffi.new("int *")
+        self._queued = ffi.new("int *")
+        self._privatep = ffi.new("void **")
+        self._prev_running = 0
 
     def setopt(self, option, value):
         "Configure multi options"
-        if option in (libcurl.CURLMOPT_SOCKETFUNCTION, libcurl.CURLMOPT_TIMERFUNCTION):
+        if option in (libcurl.CURLMOPT_SOCKETFUNCTION, libcurl.CURLMOPT_SOCKETDATA,
+                      libcurl.CURLMOPT_TIMERFUNCTION, libcurl.CURLMOPT_TIMERDATA):
             raise Exception('Callback options reserved for the event loop')
         libcurl.curl_multi_setopt(self._multi, option, value)
 
@@ -897,18 +1184,21 @@ class MCurl:
     def _socket_action(self, sock_fd, ev_bitmask):
         # Event loop callback: act on ready sockets or timeouts
         # dprint("mask = %d, sock_fd = %d" % (ev_bitmask, sock_fd))
-        handle_count = ffi.new("int *")
+        handle_count = self._handle_count
         _ = libcurl.curl_multi_socket_action(
             self._multi, sock_fd, ev_bitmask, handle_count)
 
-        # Check if any handles have finished.
-        if handle_count != len(self.handles):
+        # Check if any handles have finished - running count dropped
+        running = handle_count[0]
+        if running < self._prev_running:
             self._update_transfers()
+        self._prev_running = running
 
     def _update_transfers(self):
         # Mark finished handles as done
+        queued = self._queued
+        privatep = self._privatep
         while True:
-            queued = ffi.new("int *")
             pmsg: ffi.new("CURLMsg *") = libcurl.curl_multi_info_read(
                 self._multi, queued)
             if pmsg == ffi.NULL:
@@ -917,52 +1207,97 @@ class MCurl:
             msg = pmsg[0]
             if msg.msg == libcurl.CURLMSG_DONE:
                 # Always true since only one msg type
-                easyhash = gethash(msg.easy_handle)
-                curl = self.handles[easyhash]
-                curl.done = True
-
+                libcurl.curl_easy_getinfo(
+                    msg.easy_handle, libcurl.CURLINFO_PRIVATE, privatep)
+                curl = cvp2curl(privatep[0])
                 if msg.data.result != libcurl.CURLE_OK:
                     curl.cerr = msg.data.result
                     curl.errstr = str(msg.data.result) + "; "
 
+                # Complete the result before waking up the waiting thread
+                curl._trim()
+                curl.done = True
+                with self._progress:
+                    self._progress.notify_all()
+
     # Adding to multi
 
     def _add_handle(self, curl: Curl):
-        # Add a handle
-        dprint(curl.easyhash + ": Add handle")
-        if curl.easyhash not in self.handles:
-            self.handles[curl.easyhash] = curl
-            libcurl.curl_multi_add_handle(self._multi, curl.easy)
+        # Add a handle - needs self._lock
+        libcurl.curl_multi_add_handle(self._multi, curl.easy)
+        self._prev_running += 1
+        if DEBUG:
             dprint(curl.easyhash + ": Added handle")
-        else:
-            dprint(curl.easyhash + ": Active handle")
+
+    def _add_pending(self):
+        # Add all handles queued by add() - needs self._lock
+        while len(self.pending) != 0:
+            self._add_handle(self.pending.popleft())
 
     def add(self, curl: Curl):
         "Add a Curl handle to perform"
-        with self._lock:
-            dprint(curl.easyhash + ": Handles = %d" % len(self.handles))
-            self._add_handle(curl)
+        if DEBUG:
+            dprint(curl.easyhash + ": Add handle, handles = %d" % len(self.handles))
+        with self._handles_lock:
+            # Check and insert together so concurrent add() calls for the
+            # same handle cannot both add it to the multi
+            if curl.easykey in self.handles:
+                if DEBUG:
+                    dprint(curl.easyhash + ": Active handle")
+                return
+
+            self.handles[curl.easykey] = curl
+            curl.multi = self
+        if self._lock.acquire(blocking=False):
+            try:
+                self._add_handle(curl)
+            finally:
+                self._lock.release()
+        else:
+            # Another thread is performing - queue the handle and wake it up
+            # to add it rather than waiting for select() to return
+            if DEBUG:
+                dprint(curl.easyhash + ": Queued handle")
+            self.pending.append(curl)
+            try:
+                self.wakeup[1].send(b"\0")
+            except BlockingIOError:
+                # Wakeup already pending
+                pass
 
     # Removing from multi
 
     def _remove_handle(self, curl: Curl, errstr=""):
         # Remove a handle and set status
-        if curl.easyhash not in self.handles:
+        if curl.easykey not in self.handles:
             return
 
         if curl.done is False:
+            curl._trim()
             curl.done = True
+            with self._progress:
+                self._progress.notify_all()
 
         if len(errstr) != 0:
             curl.errstr += errstr + "; "
 
-        dprint(curl.easyhash + ": Remove handle: " + curl.errstr)
-        libcurl.curl_multi_remove_handle(self._multi, curl.easy)
+        if DEBUG:
+            dprint(curl.easyhash + ": Remove handle: " + curl.errstr)
+        if curl in self.pending:
+            # Not added to multi yet
+            self.pending.remove(curl)
+        else:
+            libcurl.curl_multi_remove_handle(self._multi, curl.easy)
 
-        self.handles.pop(curl.easyhash)
+        with self._handles_lock:
+            self.handles.pop(curl.easykey)
+        curl.multi = None
 
     def remove(self, curl: Curl):
         "Remove a Curl handle once done"
+        if curl.easykey not in self.handles:
+            # Never added or already removed - only the owner adds it back
+            return
         with self._lock:
             self._remove_handle(curl)
 
@@ -973,45 +1308,73 @@ class MCurl:
 
     # Executing multi
 
-    def _perform(self):
-        # Perform all tasks in the multi instance
-        with self._lock:
-            rlen = len(self.rlist)
-            wlen = len(self.wlist)
-            if rlen != 0 or wlen != 0:
-                rready, wready, xready = select.select(
-                    self.rlist, self.wlist, set(self.rlist) | set(self.wlist), self.timer)
+    def _perform(self, blocking=True):
+        # Perform all tasks in the multi instance - returns False without
+        # waiting if not blocking and another thread is already performing
+        if not self._lock.acquire(blocking):
+            return False
+        with self._progress:
+            self._performing = True
+        try:
+            if len(self.wanted) == 0 and self.timer is None:
+                # Nothing for libcurl to wait on
+                ready = self.sel.select(0)
             else:
-                rready, wready, xready = [], [], []
-                if self.timer is not None:
-                    # Sleeping within lock - needs fix
-                    time.sleep(self.timer)
+                # Wakeup socket is always registered so add() can interrupt
+                ready = self.sel.select(self.timer)
+
+            wakeup = self.wakeup[0]
+            count = len(ready)
+            ready = [(key, events) for key, events in ready if key.fileobj is not wakeup]
+            if len(ready) != count:
+                # Woken up by add() - clear and add queued handles below
+                try:
+                    wakeup.recv(4096)
+                except BlockingIOError:
+                    pass
+            self._add_pending()
 
-            if len(rready) == 0 and len(wready) == 0 and len(xready) == 0:
+            if len(ready) == 0:
                 # dprint("No activity")
-                self._socket_action(libcurl.CURL_SOCKET_TIMEOUT, 0)
+                if self.timer is not None:
+                    # Timer expired - no timer means libcurl has nothing
+                    # pending so a timeout action would be a wasted call
+                    self._socket_action(libcurl.CURL_SOCKET_TIMEOUT, 0)
             else:
-                for sock_fd in rready:
-                    # dprint("Ready to read sock_fd %d" % sock_fd)
-                    self._socket_action(sock_fd, libcurl.CURL_CSELECT_IN)
-                for sock_fd in wready:
-                    # dprint("Ready to write sock_fd %d" % sock_fd)
-                    self._socket_action(sock_fd, libcurl.CURL_CSELECT_OUT)
-                for sock_fd in xready:
-                    # dprint("Error sock_fd %d" % sock_fd)
-                    self._socket_action(sock_fd, libcurl.CURL_CSELECT_ERR)
+                for key, events in ready:
+                    # Errors are reported by the selector as read/write
+                    # readiness - libcurl detects them when acting on sock_fd
+                    ev_bitmask = 0
+                    if events & selectors.EVENT_READ:
+                        # dprint("Ready to read sock_fd %d" % key.fd)
+                        ev_bitmask |= libcurl.CURL_CSELECT_IN
+                    if events & selectors.EVENT_WRITE:
+                        # dprint("Ready to write sock_fd %d" % key.fd)
+                        ev_bitmask |= libcurl.CURL_CSELECT_OUT
+                    self._socket_action(key.fd, ev_bitmask)
+        finally:
+            # Release under _progress so a waiter in do() cannot miss it
+            with self._progress:
+                self._performing = False
+                self._lock.release()
+                self._progress.notify_all()
+
+        return True
 
     def do(self, curl: Curl):
         "Add a Curl handle and peform until completion"
         if not curl.is_easy:
             self.add(curl)
-            while True:
-                if curl.done:
-                    break
-                self._perform()
-                time.sleep(0.01)
+            while not curl.done:
+                if not self._perform(blocking=False):
+                    # Another thread is performing - wait until it completes
+                    # this transfer or stops performing, then take over
+                    with self._progress:
+                        while self._performing and not curl.done:
+                            self._progress.wait()
         else:
-            dprint(curl.easyhash + ": Using easy interface")
+            if DEBUG:
+                dprint(curl.easyhash + ": Using easy interface")
             curl.perform()
 
         # Map some libcurl error codes to HTTP errors
@@ -1058,34 +1421,38 @@ class MCurl:
                     curl.errstr += out + "; "
 
                     # Add this proxy to failed list and don't try again
-                    with self._lock:
+                    with self._failed_lock:
                         self.failed.append(curl.proxy)
                 else:
                     # Setup client to authenticate directly with upstream proxy
-                    dprint(curl.easyhash +
-                           ": Client to authenticate with upstream proxy")
+                    if DEBUG:
+                        dprint(curl.easyhash +
+                               ": Client to authenticate with upstream proxy")
                     if not curl.is_connect:
                         # curl.errstr not set else connection will get closed during auth
                         curl.resp = codep
 
         if curl.is_connect and curl.sock_fd is None:
             # Need sock_fd for select()
-            if curl_version() < 0x072D00:
+            if not CURL_HAS_ACTIVESOCKET:
                 # This should never happen since we have set CURLOPT_FRESH_CONNECT = True
                 # for CONNECT
                 out = "Cannot reuse an SSL connection with libcurl < v7.45 - should never happen"
-                dprint(curl.easyhash + ": " + out)
+                if DEBUG:
+                    dprint(curl.easyhash + ": " + out)
                 curl.errstr += out + "; "
                 curl.resp = 500
             else:
                 # Get the active socket using getinfo() for select()
-                dprint(curl.easyhash + ": Getting active socket")
+                if DEBUG:
+                    dprint(curl.easyhash + ": Getting active socket")
                 ret, sock_fd = curl.get_activesocket()
                 if ret == libcurl.CURLE_OK:
                     curl.sock_fd = sock_fd
                 else:
                     out = f"Failed to get active socket: {ret}, {sock_fd}"
-                    dprint(curl.easyhash + ": " + out)
+                    if DEBUG:
+                        dprint(curl.easyhash + ": " + out)
                     curl.errstr += out + "; "
                     curl.resp = 503
 
@@ -1093,134 +1460,247 @@ class MCurl:
 
     def select(self, curl: Curl, client_sock, idle=30):
         "Run select loop between client and curl"
-        # TODO figure out if IPv6 or IPv4
         if curl.sock_fd is None:
-            dprint(curl.easyhash + ": Cannot select() without active socket")
+            if DEBUG:
+                dprint(curl.easyhash + ": Cannot select() without active socket")
             return
 
-        dprint(curl.easyhash + ": Starting select loop")
-        curl_sock = socket.fromfd(
-            curl.sock_fd, socket.AF_INET, socket.SOCK_STREAM)
-
         ret, used_proxy = curl.get_used_proxy()
         if ret != libcurl.CURLE_OK:
-            dprint(curl.easyhash + ": Failed to get used proxy: " + str(ret))
+            if DEBUG:
+                dprint(curl.easyhash + ": Failed to get used proxy: " + str(ret))
             return
 
-        if curl.is_connect and (not curl.is_tunnel and used_proxy):
-            # Send original headers from client to tunnel and authenticate with
-            # upstream proxy
-            dprint(curl.easyhash + ": Sending original client headers")
-            curl_sock.sendall((f"{curl.method} {curl.url} {curl.request_version}\r\n").
-                              encode("utf-8"))
-            if curl.xheaders is not None:
-                for header in curl.xheaders:
-                    curl_sock.sendall(
-                        f"{header}: {curl.xheaders[header]}\r\n".encode("utf-8"))
-            curl_sock.sendall(b"\r\n")
-
-        # sockets will be removed from these lists, when they are
-        # detected as closed by remote host; wlist contains sockets
-        # only when data has to be written
+        if DEBUG:
+            dprint(curl.easyhash + ": Starting select loop")
+        # Wrap libcurl's socket without dup() - family and type are detected
+        # from the fd, detached below so that libcurl still owns it
+        curl_sock = socket.socket(fileno=curl.sock_fd)
+        try:
+            if curl.is_connect and (not curl.is_tunnel and used_proxy):
+                # Send original headers from client to tunnel and authenticate with
+                # upstream proxy
+                if DEBUG:
+                    dprint(curl.easyhash + ": Sending original client headers")
+                lines = [f"{curl.method} {curl.url} {curl.request_version}"]
+                if curl.xheaders is not None:
+                    lines.extend(f"{header}: {value}"
+                                 for header, value in curl.xheaders.items())
+                lines.extend(["", ""])
+                curl_sock.sendall("\r\n".join(lines).encode("utf-8"))
+
+            if hasattr(os, "splice") and type(client_sock) is socket.socket:
+                # Linux - move data between sockets within the kernel
+                cl, cs = self._splice(curl, client_sock, curl_sock, idle)
+            else:
+                cl, cs = self._relay(curl, client_sock, curl_sock, idle)
+
+            # After serving the proxy tunnel it could not be used for samething else.
+            # A proxy doesn't really know, when a proxy tunnnel isn't needed any
+            # more (there is no content length for data). So servings will be ended
+            # either after timeout seconds without data transfer or when at least
+            # one side closes the connection. Close both proxy and client
+            # connection if still open.
+            if DEBUG:
+                dprint(curl.easyhash + ": %d bytes read, %d bytes written" % (cl, cs))
+        finally:
+            curl_sock.detach()
+
+    def _relay(self, curl: Curl, client_sock, curl_sock, idle):
+        # Relay data between client and curl sockets via recv()/send()
+        # Data waiting to be written to each socket - sockets are only
+        # selected for writing while they have pending data
+        pending = {client_sock: bytearray(), curl_sock: bytearray()}
+        peer = {client_sock: curl_sock, curl_sock: client_sock}
+        sources = {client_sock: "client", curl_sock: "server"}
         rlist = [client_sock, curl_sock]
-        wlist = []
 
-        # data to be written to client connection and proxy socket
+        # Reused for every recv() - data is only copied if not sent at once
+        buf = bytearray(TUNNEL_BUFSIZE)
+        view = memoryview(buf)
+
+        def send(sock, data):
+            # socket.send() may send only a part of the data - the rest
+            # is sent when select() finds the socket writable again
+            try:
+                bsnt = sock.send(data)
+            except BlockingIOError:
+                bsnt = 0
+            if bsnt == 0:
+                if DEBUG:
+                    dprint(curl.easyhash + ": No data sent")
+            return bsnt
+
         cl = 0
         cs = 0
-        cdata = []
-        sdata = []
-        max_idle = time.time() + idle
-        while (rlist or wlist):
+        max_idle = time.monotonic() + idle
+        while True:
+            wlist = [sock for sock, data in pending.items() if len(data) != 0]
+            if not (rlist or wlist):
+                break
+
             (ins, outs, exs) = select.select(rlist, wlist, rlist, idle)
             if exs:
-                dprint(curl.easyhash + ": Exception, breaking")
+                if DEBUG:
+                    dprint(curl.easyhash + ": Exception, breaking")
                 break
-            if ins:
-                for i in ins:
-                    if i is curl_sock:
-                        out = client_sock
-                        wdata = cdata
-                        source = "server"
-                    else:
-                        out = curl_sock
-                        wdata = sdata
-                        source = "client"
-
-                    try:
-                        data = i.recv(4096)
-                    except ConnectionError as exc:
-                        # Fix #152 - handle connection errors gracefully
+            active = False
+            for i in ins:
+                source = sources[i]
+                try:
+                    datalen = i.recv_into(buf)
+                except ConnectionError as exc:
+                    # Fix #152 - handle connection errors gracefully
+                    if DEBUG:
                         dprint(curl.easyhash + ": from %s: " %
                                source + str(exc))
-                        data = ""
-                    datalen = len(data)
-                    if datalen != 0:
-                        cl += datalen
-                        # Prepare data to send it later in outs section
-                        wdata.append(data)
-                        if out not in outs:
-                            outs.append(out)
-                        max_idle = time.time() + idle
-                    else:
-                        # No data means connection closed by remote host
+                    datalen = 0
+                if datalen != 0:
+                    cl += datalen
+                    active = True
+                    out = peer[i]
+                    bsnt = 0
+                    if len(pending[out]) == 0:
+                        # Send without waiting for the next select()
+                        bsnt = send(out, view[:datalen])
+                        cs += bsnt
+                    pending[out] += view[bsnt:datalen]
+                else:
+                    # No data means connection closed by remote host
+                    if DEBUG:
                         dprint(curl.easyhash +
                                ": Connection closed by %s" % source)
-                        # Because tunnel is closed on one end there is
-                        # no need to read from both ends
-                        del rlist[:]
-                        # Do not write anymore to the closed end
-                        if i in wlist:
-                            wlist.remove(i)
-                        if i in outs:
-                            outs.remove(i)
-            if outs:
-                for o in outs:
-                    if o is curl_sock:
-                        wdata = sdata
-                    else:
-                        wdata = cdata
-                    data = wdata[0]
-                    # socket.send() may sending only a part of the data
-                    # (as documentation says). To ensure sending all data
-                    bsnt = o.send(data)
-                    if bsnt > 0:
-                        if bsnt < len(data):
-                            # Not all data was sent; store data not
-                            # sent and ensure select() get's it when
-                            # the socket can be written again
-                            wdata[0] = data[bsnt:]
-                            if o not in wlist:
-                                wlist.append(o)
-                        else:
-                            wdata.pop(0)
-                            if not data and o in wlist:
-                                wlist.remove(o)
-                        cs += bsnt
-                    else:
-                        dprint(curl.easyhash + ": No data sent")
-                max_idle = time.time() + idle
-            if max_idle < time.time():
+                    # Because tunnel is closed on one end there is
+                    # no need to read from both ends
+                    rlist = []
+                    # Do not write anymore to the closed end
+                    pending[i].clear()
+
+            for o in outs:
+                data = pending[o]
+                if len(data) != 0:
+                    bsnt = send(o, data)
+                    del data[:bsnt]
+                    cs += bsnt
+                    if bsnt != 0:
+                        active = True
+            # Clock only read once per pass - deadline moves on data events
+            now = time.monotonic()
+            if active:
+                max_idle = now + idle
+            elif max_idle < now:
                 # No data in timeout seconds
-                dprint(curl.easyhash + ": Server connection timeout")
+                if DEBUG:
+                    dprint(curl.easyhash + ": Server connection timeout")
                 break
 
-        # After serving the proxy tunnel it could not be used for samething else.
-        # A proxy doesn't really know, when a proxy tunnnel isn't needed any
-        # more (there is no content length for data). So servings will be ended
-        # either after timeout seconds without data transfer or when at least
-        # one side closes the connection. Close both proxy and client
-        # connection if still open.
-        dprint(curl.easyhash + ": %d bytes read, %d bytes written" % (cl, cs))
+        return cl, cs
+
+    def _splice(self, curl: Curl, client_sock, curl_sock, idle):
+        # Relay data between client and curl sockets via os.splice() through
+        # a pipe per direction so data is never copied into Python
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        pipes = (os.pipe(), os.pipe())
+
+        # [source, destination, pipe, bytes pending in pipe, name]
+        directions = [
+            [client_sock, curl_sock, pipes[0], 0, "client"],
+            [curl_sock, client_sock, pipes[1], 0, "server"]
+        ]
+
+        cl = 0
+        cs = 0
+        closed = False
+        max_idle = time.monotonic() + idle
+        try:
+            while True:
+                # Only read more once the pipe has been drained into destination
+                rlist = [] if closed else [d[0] for d in directions if d[3] == 0]
+                wlist = [d[1] for d in directions if d[3] != 0]
+                if not (rlist or wlist):
+                    break
+
+                (ins, outs, exs) = select.select(rlist, wlist, rlist, idle)
+                if exs:
+                    if DEBUG:
+                        dprint(curl.easyhash + ": Exception, breaking")
+                    break
+                active = False
+                for d in directions:
+                    src, dst, (rpipe, wpipe), pending, source = d
+                    if src in ins:
+                        try:
+                            datalen = os.splice(
+                                src.fileno(), wpipe, TUNNEL_BUFSIZE, flags=flags)
+                        except BlockingIOError:
+                            continue
+                        except ConnectionError as exc:
+                            # Fix #152 - handle connection errors gracefully
+                            if DEBUG:
+                                dprint(curl.easyhash + ": from %s: " %
+                                       source + str(exc))
+                            datalen = 0
+                        if datalen == 0:
+                            # No data means connection closed by remote host -
+                            # stop reading both ends, flush what is pending
+                            if DEBUG:
+                                dprint(curl.easyhash +
+                                       ": Connection closed by %s" % source)
+                            closed = True
+                            continue
+                        cl += datalen
+                        pending += datalen
+                        active = True
+
+                    # Write out as much as destination accepts right away
+                    while pending != 0:
+                        try:
+                            bsnt = os.splice(
+                                rpipe, dst.fileno(), pending, flags=flags)
+                        except BlockingIOError:
+                            break
+                        except ConnectionError as exc:
+                            if DEBUG:
+                                dprint(curl.easyhash + ": relaying from %s: " %
+                                       source + str(exc))
+                            return cl, cs
+                        pending -= bsnt
+                        cs += bsnt
+                        active = True
+                    d[3] = pending
+
+                # Clock only read once per pass - deadline moves on data events
+                now = time.monotonic()
+                if active:
+                    max_idle = now + idle
+                elif max_idle < now:
+                    # No data in timeout seconds
+                    if DEBUG:
+                        dprint(curl.easyhash + ": Server connection timeout")
+                    break
+        finally:
+            for rpipe, wpipe in pipes:
+                os.close(rpipe)
+                os.close(wpipe)
+
+        return cl, cs
 
     # Cleanup multi
 
     def close(self):
         "Stop any running transfers and close this multi handle"
-        dprint("Closing multi")
-        for easyhash in tuple(self.handles):
-            self.stop(self.handles[easyhash])
+        if DEBUG:
+            dprint("Closing multi")
+        with self._handles_lock:
+            curls = tuple(self.handles.values())
+        for curl in curls:
+            self.stop(curl)
+        self.easy_pool.clear()
         libcurl.curl_multi_cleanup(self._multi)
+        self.sel.close()
+        for sock in self.wakeup:
+            sock.close()
 
         global MCURL
-        MCURL = None
+        if MCURL is self:
+            MCURL = None
@@ -1,5 +1,9 @@
+import ast
 import glob
+import hashlib
+import operator
 import os
+import re
 import shutil
 import subprocess
 import sys
@@ -91,48 +95,76 @@ FILTERS = [
     "va_list",
     "__asm__"
 ]
+FILTERS_RE = re.compile("|".join(re.escape(filt) for filt in FILTERS))
+
+# #define CURL_XXX value
+DEFINE_RE = re.compile(r"#define (CURL[^ ]*) (.*)")
+
+# Operators allowed in #define values
+BINOPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+    ast.BitOr: operator.or_,
+    ast.BitAnd: operator.and_,
+    ast.BitXor: operator.xor
+}
+UNARYOPS = {
+    ast.Invert: operator.invert,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos
+}
 
 DEFINES = {}
 
 
+def eval_define(node):
+    # Evaluate parsed #define value - numbers, arithmetic / bitwise operators
+    # and names of #defines already resolved
+    if isinstance(node, ast.Constant) and type(node.value) in [int, float]:
+        return node.value
+    elif isinstance(node, ast.Name):
+        return DEFINES[node.id]
+    elif isinstance(node, ast.BinOp) and type(node.op) in BINOPS:
+        return BINOPS[type(node.op)](eval_define(node.left), eval_define(node.right))
+    elif isinstance(node, ast.UnaryOp) and type(node.op) in UNARYOPS:
+        return UNARYOPS[type(node.op)](eval_define(node.operand))
+
+    raise ValueError("Unsupported #define value: " + ast.dump(node))
+
+
 def code_cleanup(code):
     # Align code
-    defines = ""
-    codeout = ""
+    defines = []
+    codeout = []
     for line in code.splitlines():
-        # Clean up whitespace
-        sline = line.strip()
-
         # Remove empty lines
-        if len(sline) == 0:
+        if len(line.strip()) == 0:
             continue
 
         # Remove leading whitespaces
-        i = 0
-        while line[i] == " ":
-            i += 1
-        line = line[i:]
+        line = line.lstrip(" ")
 
         # Separate out #define
         # Some #define refer to enum values which won't work
         if line.startswith("#define"):
-            defines += line + "\n"
+            defines.append(line + "\n")
             continue
 
         # Reduce newlines
-        codeout += line + " "
+        codeout.append(line + " ")
         if line[-1] == ";":
-            codeout += "\n"
+            codeout.append("\n")
 
-    codeout2 = ""
-    for line in (defines + codeout).splitlines():
+    codeout2 = []
+    for line in "".join(defines + codeout).splitlines():
         # Skip lines with FILTERS
-        skip = False
-        for filt in FILTERS:
-            if filt in line:
-                skip = True
-                break
-        if skip:
+        if FILTERS_RE.search(line) is not None:
             continue
 
         # Remove static void functions
@@ -141,46 +173,42 @@ def code_cleanup(code):
 
         # Resolve #defines
         if line.startswith("#define"):
-            spl = line.split(" ", 2)
-            if len(spl) == 3 and spl[1].startswith("CURL"):
-                # Casting in #define
-                if "(unsigned long)" in spl[2]:
-                    spl[2] = spl[2].replace("(unsigned long)", "")
-
-                if spl[2] in DEFINES:
-                    # define CURL_YYY CURL_XXX
-                    val = DEFINES[spl[2]]
-                else:
-                    if "CURL" in spl[2]:
-                        # define CURL_ZZZ (CURL_XXX | CURL_YYY)
-                        for key in sorted(DEFINES.keys(), reverse=True):
-                            if key in spl[2]:
-                                spl[2] = spl[2].replace(key, str(DEFINES[key]))
-
-                    # Evaluate value in Python - works for bit shifts, |, etc.
-                    try:
-                        val = eval(spl[2])
-                    except:
-                        continue
-
-                    # Workaround for ~(unsigned long)
-                    if spl[1].startswith("CURLAUTH_ANY"):
-                        if sys.platform == "win32":
-                            val += 0xffffffff + 1
-                        else:
-                            val += 0xffffffffffffffff + 1
-
-                if type(val) in [int, float]:
-                    line = f"#define {spl[1]} {val}"
-                    DEFINES[spl[1]] = val
-                else:
+            match = DEFINE_RE.match(line)
+            if match is None:
+                continue
+            name, expr = match.groups()
+
+            # Casting in #define
+            if "(unsigned long)" in expr:
+                expr = expr.replace("(unsigned long)", "")
+
+            if expr in DEFINES:
+                # define CURL_YYY CURL_XXX
+                val = DEFINES[expr]
+            else:
+                # Evaluate value - works for bit shifts, |, etc. and
+                # define CURL_ZZZ (CURL_XXX | CURL_YYY)
+                try:
+                    val = eval_define(ast.parse(expr, mode="eval").body)
+                except Exception:
                     continue
+
+                # Workaround for ~(unsigned long)
+                if name.startswith("CURLAUTH_ANY"):
+                    if sys.platform == "win32":
+                        val += 0xffffffff + 1
+                    else:
+                        val += 0xffffffffffffffff + 1
+
+            if type(val) in [int, float]:
+                line = f"#define {name} {val}"
+                DEFINES[name] = val
             else:
                 continue
 
-        codeout2 += line + "\n"
+        codeout2.append(line + "\n")
 
-    return codeout2
+    return "".join(codeout2)
 
 
 def gen_callbacks(code):
@@ -195,8 +223,36 @@ def gen_callbacks(code):
     return callbacks
 
 
+def get_cachefile(sfile, incs=[], defines=[], recurse=False):
+    # Path to cached get_preprocessor() output for these inputs - keyed on
+    # the headers, arguments, this file and the compiler version
+    key = hashlib.sha256()
+    key.update(repr((sys.platform, sfile, [str(inc) for inc in incs],
+                     defines, recurse)).encode("utf-8"))
+
+    hdirs = [os.path.dirname(sfile) or "."] + [str(inc) for inc in incs]
+    for hdir in hdirs:
+        for hfile in sorted(glob.glob(os.path.join(glob.escape(hdir), "*.h"))):
+            with open(hfile, "rb") as f:
+                key.update(f.read())
+
+    with open(__file__, "rb") as f:
+        key.update(f.read())
+
+    p = subprocess.run("gcc --version", capture_output=True, shell=True)
+    key.update(p.stdout)
+
+    cachedir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cachedir, "mcurl", "preproc", key.hexdigest() + ".h")
+
+
 def get_preprocessor(sfile, incs=[], defines=[], recurse=False):
     # Get preprocessed output from the C/C++ compiler
+    cachefile = get_cachefile(sfile, incs, defines, recurse)
+    if os.path.exists(cachefile):
+        with open(cachefile, "r") as f:
+            return f.read()
+
     args = ["gcc"]
     start = False
 
@@ -269,6 +325,14 @@ def get_preprocessor(sfile, incs=[], defines=[], recurse=False):
     with open(os.path.basename(sfile), "w") as f:
         f.write(code)
 
+    # Save to cache - write and rename so parallel builds never read a
+    # partial file
+    os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+    tmpfile = f"{cachefile}.{os.getpid()}"
+    with open(tmpfile, "w") as f:
+        f.write(code)
+    os.replace(tmpfile, cachefile)
+
     return code
 
 
@@ -1,116 +1,311 @@
+import operator
+import os
+import socket
 import sys
+import threading
 import time
 import uuid
 
 import pytest
 import pytest_httpbin
+import pytest_httpbin.certs
 
 import mcurl
+from _libcurl_cffi import lib as libcurl
 
 
 def dprint(msg):
     "Print message to stdout and debug file if open"
-    offset = 0
-    tree = ""
-    while True:
-        try:
-            name = sys._getframe(offset).f_code.co_name
-            offset += 1
-            if name != "print":
-                tree = "/" + name + tree
-            if offset > 3:
-                break
-        except ValueError:
+    frame = sys._getframe(0)
+    names = []
+    for _ in range(4):
+        if frame is None:
             break
-    sys.stdout.write(str(int(time.time())) + ": " + tree + ": " + msg + "\n")
+        name = frame.f_code.co_name
+        if name != "print":
+            names.append(name)
+        frame = frame.f_back
+    names.reverse()
+    tree = "/" + "/".join(names)
+    sys.stdout.write(str(time.time_ns() // 1_000_000_000) + ": " + tree + ": " + msg + "\n")
 
 
 mcurl.dprint = dprint
+mcurl.DEBUG = True
 
+# Set MCURL_TEST_VERBOSE=1 to print each request as it is tested
+VERBOSE = os.environ.get("MCURL_TEST_VERBOSE") == "1"
 
-def query(url, method="GET", data=None, check=False, insecure=False, debug=False, multi=None, encoding="utf-8"):
-    ec = mcurl.Curl(url, method)
-    ec.set_insecure(insecure)
-    ec.set_debug(debug)
-    if data is not None:
-        ec.buffer(data.encode("utf-8"))
-        ec.set_headers({"Content-Length": len(data)})
-    else:
-        ec.buffer()
-    ec.set_useragent("mcurl tester")
+# Unique request bodies and their headers, built once per run
+PAYLOADS = {method: str(uuid.uuid4()).encode("utf-8") for method in ["POST", "PUT", "PATCH"]}
+HEADERS = {method: {"Content-Length": len(data)} for method, data in PAYLOADS.items()}
+
+# libcurl features that must be available
+FEATURES = [
+    "CURL_VERSION_SSL",
+    "CURL_VERSION_SPNEGO",
+    "CURL_VERSION_KERBEROS5",
+    "CURL_VERSION_NTLM",
+    "CURL_VERSION_SSPI" if sys.platform == "win32" else "CURL_VERSION_GSSAPI"
+]
+
+
+def run(ec, multi=None):
+    # Perform standalone or through the multi instance, return curl error
     if multi is None:
-        print(f"\nTesting {method} {url}")
-        ret = ec.perform()
-    else:
-        print(f"\nTesting {method} {url} multi")
-        ret = 0 if multi.do(ec) else 1
+        return ec.perform()
+    return 0 if multi.do(ec) else 1
+
+
+def verify(ret_data, url, data=None):
+    # Check that httpbin echoed back the request
+    assert url.encode("utf-8") in ret_data, f"Failed: response does not contain {url}:\n{ret_data}"
+
+    if data is not None:
+        assert data in ret_data, f"Failed: response does not match {data}:\n{ret_data}"
+
+
+def query(url, method="GET", data=None, headers=None, check=False, insecure=False, debug=False, multi=None, cainfo=None):
+    ec = mcurl.Curl.acquire(url, method)
+    if cainfo is not None:
+        # libcurl copies the path so the temporary buffer can go
+        libcurl.curl_easy_setopt(ec.easy, libcurl.CURLOPT_CAINFO, mcurl.py2cstr(cainfo))
+    ec.configure(data=data, headers=headers, useragent="mcurl tester", insecure=insecure, debug=debug)
+    if VERBOSE:
+        print(f"\nTesting {method} {url}" + (" multi" if multi is not None else ""))
+    ret = run(ec, multi)
     assert ret == 0, f"Failed with error {ret}\n{ec.errstr}"
 
-    ret_data = ec.get_data(encoding=encoding)
-    print(f"\n{ec.get_headers()}Response length: {len(ret_data)}")
+    ret_data = ec.get_data(encoding=None)
+    if debug:
+        print(f"\n{ec.get_headers()}Response length: {len(ret_data)}")
     if check:
-        # Tests against httpbin
-        assert url in ret_data, f"Failed: response does not contain {url}:\n{ret_data}"
+        verify(ret_data, url, data)
 
-        if data is not None:
-            assert data in ret_data, f"Failed: response does not match {data}:\n{ret_data}"
+    ec.release()
 
 
-@pytest.fixture(params=["GET", "POST", "PUT", "DELETE", "PATCH"])
-def method(request):
-    # All methods to test
-    return request.param
+@pytest.fixture(scope="session")
+def shared_multi():
+    # One multi instance for all tests - released Curl instances are pooled on it
+    multi = mcurl.MCurl()
+    yield multi
+    multi.close()
 
 
-@pytest.fixture(params=[False, True])
-def is_multi(request):
-    # Single or multi
-    return request.param
+@pytest.mark.parametrize("method", ["GET", "POST", "PUT", "DELETE", "PATCH"])
+@pytest.mark.parametrize("is_multi", [False, True])
+@pytest.mark.parametrize("is_debug", [False, True])
+def test_query(method, is_multi, is_debug, httpbin, shared_multi, monkeypatch):
+    # Test all HTTP methods, single or multi, debug enabled or disabled
+    monkeypatch.setattr(mcurl, "DEBUG", is_debug)
+    testurl = httpbin.url + "/" + method.lower()
+    query(testurl, method, PAYLOADS.get(method), HEADERS.get(method), check=True,
+          debug=is_debug, multi=shared_multi if is_multi else None)
 
 
-@pytest.fixture(params=[False, True])
-def is_debug(request):
-    # Enabled or disabled
-    return request.param
+def test_binary(httpbin, shared_multi):
+    # Test binary data
+    testurl = httpbin.url + "/image/jpeg"
+    query(testurl)
+    query(testurl, multi=shared_multi)
 
 
-def test_query(method, httpbin_both, is_multi, is_debug):
-    # Test all HTTP methods
-    testurl = httpbin_both.url + "/" + method.lower()
-    data = str(uuid.uuid4()) if method in [
-        "POST", "PUT", "PATCH"] else None
-    query(testurl, method, data, check=True, insecure=True, debug=is_debug,
-          multi=mcurl.MCurl() if is_multi else None)
+def test_concurrent(httpbin, shared_multi):
+    # Test requests in flight together on one multi instance
+    ecs = []
+    for method in ["GET", "POST", "PUT", "DELETE", "PATCH"]:
+        testurl = httpbin.url + "/" + method.lower()
+        ec = mcurl.Curl.acquire(testurl, method)
+        ec.configure(data=PAYLOADS.get(method), headers=HEADERS.get(method))
+        shared_multi.add(ec)
+        ecs.append((ec, testurl, PAYLOADS.get(method)))
 
+    for ec, testurl, data in ecs:
+        assert run(ec, shared_multi) == 0, f"Failed with error\n{ec.errstr}"
+        verify(ec.get_data(encoding=None), testurl, data)
+        ec.release()
 
-def test_binary(httpbin_both, is_multi, is_debug):
-    # Test binary data
-    testurl = httpbin_both.url + "/image/jpeg"
-    query(testurl, insecure=True, debug=is_debug, encoding=None)
-    query(testurl, insecure=True, debug=is_debug, multi=mcurl.MCurl()
-          if is_multi else None, encoding=None)
+
+@pytest.mark.tls
+def test_tls(httpbin_secure, shared_multi):
+    # Test https with certificate verification against the httpbin CA
+    cainfo = pytest_httpbin.certs.where()
+    query(httpbin_secure.url + "/get", check=True, cainfo=cainfo)
+    query(httpbin_secure.url + "/post", "POST", PAYLOADS["POST"], HEADERS["POST"],
+          check=True, multi=shared_multi, cainfo=cainfo)
+
+    # Untrusted certificate fails unless verification is turned off
+    ec = mcurl.Curl.acquire(httpbin_secure.url + "/get")
+    ec.buffer()
+    assert ec.perform() != 0, f"Failed: untrusted certificate accepted\n{ec.errstr}"
+    ec.set_insecure()
+    ec.buffer()
+    assert ec.perform() == 0, f"Failed with error\n{ec.errstr}"
+    ec.release()
+
+
+@pytest.mark.tls
+@pytest.mark.parametrize("method", ["GET", "POST", "PUT", "DELETE", "PATCH"])
+@pytest.mark.parametrize("is_multi", [False, True])
+def test_query_both(method, is_multi, httpbin_secure, shared_multi):
+    # Test all HTTP methods, single or multi, over https
+    testurl = httpbin_secure.url + "/" + method.lower()
+    query(testurl, method, PAYLOADS.get(method), HEADERS.get(method), check=True,
+          insecure=True, multi=shared_multi if is_multi else None)
+
+
+def test_reuse(httpbin, shared_multi, monkeypatch):
+    # Test reusing released curl instances
+    ec = mcurl.Curl.acquire(httpbin.url + "/get")
+    with pytest.raises(ValueError):
+        ec.buffer(expected_size=-1)
+    ec.buffer(expected_size=0)
+    assert not ec.is_prealloc, "Failed: empty response preallocated"
+    ec.buffer(expected_size=65536)
+    assert shared_multi.do(ec), f"Failed with error\n{ec.errstr}"
+    ret_data = ec.client_wfile.getvalue()
+    assert ret_data.rstrip().endswith(b"}"), f"Failed: preallocated space not truncated:\n{ret_data!r}"
+    assert ec.get_data(encoding=None) == ret_data, "Failed: get_data() changed the response"
+    ec.release()
+
+    ec2 = mcurl.Curl.acquire(httpbin.url + "/post?reuse=1", "POST")
+    assert ec2 is ec, "Failed: released curl instance not reused"
+    data = str(uuid.uuid4())
+    ec2.buffer(data.encode("utf-8"), expected_size=65536)
+    ec2.set_headers({"Content-Length": len(data)})
+    assert ec2.perform() == 0, f"Failed with error\n{ec2.errstr}"
+    ret_data = ec2.get_data()
+    assert ret_data.rstrip().endswith("}"), f"Failed: preallocated space not truncated:\n{ret_data!r}"
+    assert "reuse=1" in ret_data and data in ret_data, f"Failed: unexpected response:\n{ret_data}"
+    ec2.release()
+    assert ec2.client_wfile is None and ec2.headers is None, "Failed: released instance holds request data"
+
+    # Instances released once the pool is full are not kept
+    monkeypatch.setattr(mcurl, "EASY_POOL_SIZE", len(mcurl.MCURL.easy_pool))
+    ec3 = mcurl.Curl(httpbin.url + "/get")
+    ec3.release()
+    assert ec3 not in mcurl.MCURL.easy_pool, "Failed: pool grew past EASY_POOL_SIZE"
+
+
+# Tunnel relay loops in MCurl - splice() is only available on Linux
+RELAYS = [
+    "_relay",
+    pytest.param("_splice", marks=pytest.mark.skipif(
+        not hasattr(os, "splice"), reason="os.splice() not available"))
+]
+
+
+def recvall(sock, size=None):
+    # Read until size bytes are received or the other end closes
+    data = bytearray()
+    while size is None or len(data) < size:
+        chunk = sock.recv(65536)
+        if len(chunk) == 0:
+            break
+        data += chunk
+    return bytes(data)
+
+
+def tunnel(relay, multi):
+    # Run a tunnel relay loop between two socket pairs like select() does
+    # with the client and libcurl sockets, returns the test ends and thread
+    client, client_sock = socket.socketpair()
+    curl_sock, server = socket.socketpair()
+    client_sock.setblocking(False)
+    curl_sock.setblocking(False)
+
+    ec = mcurl.Curl.acquire("http://127.0.0.1/")
+    result = []
+
+    def run_relay():
+        try:
+            result.append(getattr(multi, relay)(ec, client_sock, curl_sock, 5))
+        finally:
+            client_sock.close()
+            curl_sock.close()
+            ec.release()
+
+    thread = threading.Thread(target=run_relay, daemon=True)
+    thread.start()
+    return client, server, thread, result
+
+
+@pytest.mark.parametrize("relay", RELAYS)
+def test_tunnel(relay, shared_multi):
+    # Test a large round trip through the tunnel with the server closing first
+    data = os.urandom(3 * 1024 * 1024)
+    client, server, thread, result = tunnel(relay, shared_multi)
+
+    def echo():
+        # Echo everything back then close before the client does
+        server.sendall(recvall(server, len(data)))
+        server.close()
+
+    threads = [threading.Thread(target=echo, daemon=True),
+               threading.Thread(target=client.sendall, args=(data,), daemon=True)]
+    for t in threads:
+        t.start()
+    echoed = recvall(client, len(data))
+    for t in threads + [thread]:
+        t.join(30)
+    client.close()
+
+    assert echoed == data, f"Failed: {len(echoed)} of {len(data)} bytes echoed intact"
+    assert result == [(2 * len(data), 2 * len(data))], f"Failed: unexpected byte counts {result}"
+
+
+@pytest.mark.parametrize("relay", RELAYS)
+def test_tunnel_close(relay, shared_multi):
+    # Test data sent just before the client closes still reaches the server
+    data = os.urandom(3 * 1024 * 1024)
+    client, server, thread, result = tunnel(relay, shared_multi)
+
+    received = []
+    reader = threading.Thread(target=lambda: received.append(recvall(server)), daemon=True)
+    reader.start()
+    client.sendall(data)
+    client.close()
+    for t in [thread, reader]:
+        t.join(30)
+    server.close()
+
+    assert received == [data], "Failed: data sent before close not relayed intact"
+    assert result == [(len(data), len(data))], f"Failed: unexpected byte counts {result}"
+
+
+def test_release_multi(httpbin):
+    # Test releasing an instance performed on a multi other than the global one
+    saved = mcurl.MCURL
+    multi = mcurl.MCurl()
+    mcurl.MCURL = saved
+    try:
+        ec = mcurl.Curl.acquire(httpbin.url + "/get")
+        ec.buffer()
+        assert multi.do(ec), f"Failed with error\n{ec.errstr}"
+        ec.release()
+        assert ec.easykey not in multi.handles, "Failed: released instance still in multi"
+
+        ec2 = mcurl.Curl.acquire(httpbin.url + "/get")
+        assert ec2 is ec, "Failed: released curl instance not reused"
+        ec2.buffer()
+        assert multi.do(ec2), f"Failed with error\n{ec2.errstr}"
+        ec2.release()
+    finally:
+        multi.close()
+    assert mcurl.MCURL is saved, "Failed: closing another multi cleared the global one"
+
+
+@pytest.fixture(scope="session")
+def missing_deps():
+    # Look up libcurl features once per session
+    flags = libcurl.curl_version_info(libcurl.CURLVERSION_LAST-1).features
+    bits = operator.attrgetter(*FEATURES)(libcurl)
+    return [feature for feature, bit in zip(FEATURES, bits) if not bit & flags]
 
 
-def test_check_deps():
+def test_check_deps(missing_deps):
     # Check all dependencies are available
-    from _libcurl_cffi import lib as libcurl
-
-    features = [
-        "CURL_VERSION_SSL",
-        "CURL_VERSION_SPNEGO",
-        "CURL_VERSION_KERBEROS5",
-        "CURL_VERSION_NTLM"
-    ]
-
-    if sys.platform == "win32":
-        features.append("CURL_VERSION_SSPI")
-    else:
-        features.append("CURL_VERSION_GSSAPI")
-
-    vinfo = libcurl.curl_version_info(libcurl.CURLVERSION_LAST-1)
-    for feature in features:
-        bit = getattr(libcurl, feature)
-        avail = True if (bit & vinfo.features) > 0 else False
-        assert avail, f"Error: {feature} not available in libcurl"
+    assert not missing_deps, f"Error: {', '.join(missing_deps)} not available in libcurl"
 
     print("All dependencies available")